@@ -1,15 +1,38 @@
 """
 FastAPI server for the Walking AI Assistant
 """
-from fastapi import FastAPI, HTTPException, Depends, Body
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from typing import List, Dict, Any, Optional
-from models import User, Location, RouteRequest, WalkRecord
+from models import User, Location, RouteRequest, WalkRecord, BatchGenerateRequest, BulkWalkRequest
 from assistant_service import WalkingAssistant
+from llm_service import default_model_name
 import os
 
+# Environment variables with defaults
+DB_PATH = os.getenv("DB_PATH", "walking_assistant.db")
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+MODEL_NAME = os.getenv("MODEL_NAME") or default_model_name()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the assistant when a worker starts and release it on shutdown"""
+    # Loading the LLM blocks for a while; keep it off the event loop
+    assistant = await asyncio.to_thread(WalkingAssistant, DB_PATH, CACHE_DIR, MODEL_NAME)
+    app.state.assistant = assistant
+    yield
+    # Closes the read pool and writer, stops the LLM batcher and frees the model
+    await assistant.aclose()
+
 # Initialize the app
-app = FastAPI(title="Walking AI Assistant API")
+app = FastAPI(
+    title="Walking AI Assistant API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -20,13 +43,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Environment variables with defaults
-DB_PATH = os.getenv("DB_PATH", "walking_assistant.db")
-CACHE_DIR = os.getenv("CACHE_DIR", "cache")
-MODEL_NAME = os.getenv("MODEL_NAME", "meta-llama/Llama-2-7b-chat-hf")
+async def get_assistant(request: Request) -> WalkingAssistant:
+    """Dependency returning the assistant created at startup"""
+    return request.app.state.assistant
+
+async def _sse_events(chunks):
+    """Format text chunks as Server-Sent Events, ending with a `done` event"""
+    async for chunk in chunks:
+        # Every line of a multi-line chunk needs its own data field
+        yield "".join(f"data: {line}\n" for line in chunk.split("\n")) + "\n"
+    yield "event: done\ndata: \n\n"
 
-# Initialize assistant
-assistant = WalkingAssistant(DB_PATH, CACHE_DIR, MODEL_NAME)
+# Handlers that only touch SQLite are plain `def` so FastAPI runs them in its
+# threadpool. Handlers that call external services or run the LLM are `async`:
+# they await the shared HTTP client and the batched LLM and push SQLite,
+# parsing and geometry work onto a worker thread.
 
 @app.get("/")
 async def root():
@@ -34,78 +65,93 @@ async def root():
     return {"message": "Walking AI Assistant API is running"}
 
 @app.post("/users/", response_model=User)
-async def create_user(user_id: str, name: Optional[str] = None):
+def create_user(user_id: str, name: Optional[str] = None, assistant: WalkingAssistant = Depends(get_assistant)):
     """Register a new user"""
     return assistant.register_user(user_id, name)
 
 @app.get("/users/{user_id}", response_model=User)
-async def get_user(user_id: str):
+def get_user(user_id: str, assistant: WalkingAssistant = Depends(get_assistant)):
     """Get user information"""
     user_data = assistant.db_service.get_user(user_id)
     if not user_data:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(**user_data)
+    return User.model_construct(**user_data)
 
 @app.put("/users/{user_id}/preferences", response_model=User)
-async def update_user_preferences(
+def update_user_preferences(
     user_id: str, 
     walking_speed: Optional[float] = None, 
-    max_distance: Optional[float] = None
+    max_distance: Optional[float] = None,
+    assistant: WalkingAssistant = Depends(get_assistant)
 ):
     """Update user preferences"""
     return assistant.update_preferences(user_id, walking_speed, max_distance)
 
 @app.post("/users/{user_id}/favorite-locations/")
-async def add_favorite_location(user_id: str, location: Location):
+def add_favorite_location(user_id: str, location: Location, assistant: WalkingAssistant = Depends(get_assistant)):
     """Add a favorite location for a user"""
     location_id = assistant.add_favorite_location(user_id, location)
     return {"id": location_id, "message": "Location added successfully"}
 
 @app.get("/users/{user_id}/favorite-locations/", response_model=List[Location])
-async def get_favorite_locations(user_id: str):
+def get_favorite_locations(user_id: str, assistant: WalkingAssistant = Depends(get_assistant)):
     """Get all favorite locations for a user"""
     return assistant.get_favorite_locations(user_id)
 
 @app.post("/routes/suggest")
-async def suggest_route(route_request: RouteRequest):
+async def suggest_route(route_request: RouteRequest, assistant: WalkingAssistant = Depends(get_assistant)):
     """Suggest a walking route based on user parameters"""
-    route = assistant.suggest_route(route_request)
+    route = await assistant.suggest_route(route_request)
     
     # Add a natural language description
-    description = assistant.generate_route_description(route)
+    description = await assistant.generate_route_description(route)
     route["properties"]["description"] = description
     
     return route
 
 @app.post("/walks/record")
-async def record_walk(walk_record: WalkRecord):
+def record_walk(walk_record: WalkRecord, assistant: WalkingAssistant = Depends(get_assistant)):
     """Record a completed walk"""
     walk_id = assistant.record_completed_walk(walk_record)
     return {"id": walk_id, "message": "Walk recorded successfully"}
 
+@app.post("/walks/record/bulk")
+def record_walks_bulk(request: BulkWalkRequest, assistant: WalkingAssistant = Depends(get_assistant)):
+    """Record several completed walks at once"""
+    walk_ids = assistant.record_completed_walks(request.walks)
+    return {"ids": walk_ids, "message": f"{len(walk_ids)} walks recorded successfully"}
+
 @app.get("/users/{user_id}/walks/history")
-async def get_walking_history(user_id: str, limit: int = 10):
+def get_walking_history(user_id: str, limit: int = 10, assistant: WalkingAssistant = Depends(get_assistant)):
     """Get walking history for a user"""
     return assistant.get_walking_history(user_id, limit)
 
 @app.get("/users/{user_id}/walks/stats")
-async def get_walking_stats(user_id: str):
+def get_walking_stats(user_id: str, assistant: WalkingAssistant = Depends(get_assistant)):
     """Get aggregate walking statistics for a user"""
     return assistant.get_walking_stats(user_id)
 
 @app.get("/users/{user_id}/analysis")
-async def analyze_walking_behavior(user_id: str):
-    """Analyze user's walking behavior"""
-    analysis = assistant.analyze_walking_behavior(user_id)
+async def analyze_walking_behavior(user_id: str, stream: bool = False,
+                                   assistant: WalkingAssistant = Depends(get_assistant)):
+    """Analyze user's walking behavior, optionally streamed as Server-Sent Events"""
+    if stream:
+        return StreamingResponse(
+            _sse_events(assistant.stream_walking_analysis(user_id)),
+            media_type="text/event-stream"
+        )
+    
+    analysis = await assistant.analyze_walking_behavior(user_id)
     return {"analysis": analysis}
 
+@app.post("/generate/batch")
+async def generate_batch(request: BatchGenerateRequest, assistant: WalkingAssistant = Depends(get_assistant)):
+    """Generate text for several prompts in batched generate calls"""
+    texts = await assistant.generate_batch(request.prompts, request.max_new_tokens)
+    return {"texts": texts}
+
 @app.get("/pois")
-async def get_points_of_interest(latitude: float, longitude: float, radius: int = 500):
+async def get_points_of_interest(latitude: float, longitude: float, radius: int = 500, assistant: WalkingAssistant = Depends(get_assistant)):
     """Get points of interest around a location"""
-    pois = assistant.osm_service.get_pois_around_point(latitude, longitude, radius)
+    pois = await assistant.osm_service.aget_pois_around_point(latitude, longitude, radius)
     return pois
-
-@app.on_event("shutdown")
-def shutdown_event():
-    """Clean up resources on shutdown"""
-    assistant.close()
@@ -2,39 +2,126 @@
 Walking AI Assistant service combining all components
 """
 import os
-import datetime
-from typing import Dict, Any, List, Optional
+import time
+import asyncio
+import hashlib
+import threading
+from typing import AsyncIterator, Dict, Any, List, Optional, Tuple
 from models import User, Location, RouteRequest, WalkRecord
-from llm_service import setup_llm, generate_text
-from location_service import OpenStreetMapService, RoutingService
+from llm_service import setup_llm, unload_llm, generate_text_stream, default_model_name
+from llm_service import GenerationCache, LLMBatcher, PromptPrefix
+from location_service import OpenStreetMapService, RoutingService, make_async_client
 from db_service import DatabaseService
 
+# Invariant openings of the LLM prompts; their KV cache is computed once
+ANALYSIS_PROMPT_PREFIX = """Analyze the following walking data for a user:
+
+User preferences:
+"""
+
+# Invariant closing instructions; tokenized once alongside the prefixes
+ANALYSIS_PROMPT_SUFFIX = """
+
+Please provide a brief analysis of this user's walking behavior and habits.
+Include personalized suggestions for improvements and motivation.
+Keep your response concise and friendly."""
+
+ROUTE_PROMPT_PREFIX = """Describe the following walking route in a friendly, conversational way:
+
+Route details:
+"""
+
+ROUTE_PROMPT_SUFFIX = """
+
+Provide a brief, engaging description of this route that would encourage someone to try it.
+Include practical information like distance and time, as well as highlighting any interesting features.
+Keep your response concise and conversational."""
+
 class WalkingAssistant:
     """Main Walking AI Assistant service"""
     
-    def __init__(self, db_path, cache_dir, model_name="meta-llama/Llama-2-7b-chat-hf"):
+    def __init__(self, db_path, cache_dir, model_name=None):
         """Initialize the walking assistant"""
         # Create necessary directories
         os.makedirs(cache_dir, exist_ok=True)
         
+        # One pooled HTTP/2 client shared by the OSM and routing services
+        self.http = make_async_client()
+        
         # Initialize services
         self.db_service = DatabaseService(db_path)
-        self.osm_service = OpenStreetMapService(os.path.join(cache_dir, "osm"))
-        self.routing_service = RoutingService(os.path.join(cache_dir, "routes"), self.osm_service)
+        self.osm_service = OpenStreetMapService(os.path.join(cache_dir, "osm"), self.http)
+        self.routing_service = RoutingService(os.path.join(cache_dir, "routes"), self.osm_service, self.http)
         
         # Initialize LLM
+        self.model_name = model_name = model_name or default_model_name()
         self.model, self.tokenizer = setup_llm(model_name)
+        self.analysis_prefix_cache = PromptPrefix(
+            self.model, self.tokenizer, ANALYSIS_PROMPT_PREFIX, ANALYSIS_PROMPT_SUFFIX
+        )
+        self.route_prefix_cache = PromptPrefix(
+            self.model, self.tokenizer, ROUTE_PROMPT_PREFIX, ROUTE_PROMPT_SUFFIX
+        )
+        
+        # Concurrent requests share generate calls
+        self.llm_batcher = LLMBatcher(self.model, self.tokenizer)
+        
+        # Identical prompts skip generation: an in-process LRU in front of a
+        # persistent cache that survives restarts
+        self.llm_cache = GenerationCache(os.path.join(cache_dir, "llm_cache.sqlite"), model_name)
+    
+    async def cached_generate(self, prompt: str, max_new_tokens: int,
+                              prefix: Optional[PromptPrefix] = None) -> str:
+        """Generate text for a prompt, reusing earlier output for identical prompts"""
+        prompt_hash = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+        text = await asyncio.to_thread(self.llm_cache.get, prompt_hash, max_new_tokens)
+        if text is None:
+            text = await self.llm_batcher.submit(prompt, max_new_tokens, prefix)
+            await asyncio.to_thread(self.llm_cache.put, prompt_hash, max_new_tokens, text)
+        return text
+    
+    async def cached_generate_stream(self, prompt: str, max_new_tokens: int,
+                                     prefix: Optional[PromptPrefix] = None) -> AsyncIterator[str]:
+        """Stream generated text for a prompt, replaying cached output when available"""
+        prompt_hash = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+        text = await asyncio.to_thread(self.llm_cache.get, prompt_hash, max_new_tokens)
+        if text is not None:
+            yield text
+            return
+        
+        # Each step of the token iterator blocks, so pull it from a worker thread.
+        # The batcher's lock keeps streams from running generate alongside its
+        # batches, and stop ends generation once the client disconnects
+        chunks = []
+        stop = threading.Event()
+        stream = generate_text_stream(self.model, self.tokenizer, prompt, max_new_tokens=max_new_tokens,
+                                      prefix=prefix, lock=self.llm_batcher.lock, stop=stop)
+        try:
+            while (chunk := await asyncio.to_thread(next, stream, None)) is not None:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            stop.set()
+        
+        await asyncio.to_thread(self.llm_cache.put, prompt_hash, max_new_tokens, "".join(chunks).strip())
+    
+    async def generate_batch(self, prompts: List[str], max_new_tokens: int) -> List[str]:
+        """Generate text for several prompts; the batcher runs them as shared generate calls"""
+        return list(await asyncio.gather(
+            *(self.cached_generate(prompt, max_new_tokens) for prompt in prompts)
+        ))
     
     def register_user(self, user_id: str, name: Optional[str] = None) -> User:
         """Register a new user or return existing user"""
         user_data = self.db_service.create_user(user_id, name)
-        return User(**user_data)
+        # Rows come straight from our own users table, so skip validation
+        return User.model_construct(**user_data)
     
     def update_preferences(self, user_id: str, walking_speed: Optional[float] = None,
                            max_distance: Optional[float] = None) -> User:
         """Update user preferences"""
         user_data = self.db_service.update_user_preferences(user_id, walking_speed, max_distance)
-        return User(**user_data)
+        return User.model_construct(**user_data)
     
     def add_favorite_location(self, user_id: str, location: Location) -> int:
         """Add a favorite location for a user"""
@@ -49,8 +136,9 @@ class WalkingAssistant:
     def get_favorite_locations(self, user_id: str) -> List[Location]:
         """Get all favorite locations for a user"""
         locations_data = self.db_service.get_favorite_locations(user_id)
+        # Rows come from our own database, so skip Pydantic validation
         return [
-            Location(
+            Location.model_construct(
                 latitude=loc['latitude'],
                 longitude=loc['longitude'],
                 name=loc['name'],
@@ -58,38 +146,52 @@ class WalkingAssistant:
             ) for loc in locations_data
         ]
     
-    def suggest_route(self, route_request: RouteRequest) -> Dict[str, Any]:
+    def _load_route_user(self, user_id: str) -> Dict[str, Any]:
+        """Get user preferences, creating the user if it doesn't exist"""
+        user_data = self.db_service.get_user(user_id)
+        if not user_data:
+            user_data = self.db_service.create_user(user_id)
+        return user_data
+    
+    async def suggest_route(self, route_request: RouteRequest) -> Dict[str, Any]:
         """Suggest a walking route based on user parameters"""
         # Get user preferences
-        user_data = self.db_service.get_user(route_request.user_id)
-        if not user_data:
-            # Create user if doesn't exist
-            user_data = self.db_service.create_user(route_request.user_id)
+        user_data = await asyncio.to_thread(self._load_route_user, route_request.user_id)
         
         # Use user preferences if request doesn't specify
         max_distance = route_request.max_distance_km or user_data['preferred_max_distance']
         
         if route_request.scenic:
             # Generate a scenic circular route
-            route = self.routing_service.generate_scenic_route(
+            route = await self.routing_service.agenerate_scenic_route(
                 route_request.start_location.latitude,
                 route_request.start_location.longitude,
-                max_distance_km=max_distance
+                max_distance_km=max_distance,
+                include_geometry=route_request.include_geometry
             )
         elif route_request.end_location:
             # Generate a route from start to end
-            route = self.routing_service.get_walking_route(
+            route = await self.routing_service.aget_walking_route(
                 route_request.start_location.latitude,
                 route_request.start_location.longitude,
                 route_request.end_location.latitude,
                 route_request.end_location.longitude
             )
         else:
-            # Generate a circular route based on isochrone (time-based)
-            isochrone = self.osm_service.generate_walkable_isochrone(
-                route_request.start_location.latitude,
-                route_request.start_location.longitude,
-                walking_time_minutes=int(max_distance * 12)  # Rough estimate: 5km/h = 12min/km
+            # Generate a circular route based on isochrone (time-based), and
+            # fetch the POIs within this area at the same time
+            isochrone, pois = await asyncio.gather(
+                asyncio.to_thread(
+                    self.osm_service.generate_walkable_isochrone,
+                    route_request.start_location.latitude,
+                    route_request.start_location.longitude,
+                    walking_time_minutes=int(max_distance * 12)  # Rough estimate: 5km/h = 12min/km
+                ),
+                self.osm_service.aget_pois_around_point(
+                    route_request.start_location.latitude,
+                    route_request.start_location.longitude,
+                    radius=max_distance * 1000
+                )
             )
             
             # For circular routes, we'll return the isochrone as a suggestion area
@@ -111,13 +213,6 @@ class WalkingAssistant:
                 }
             }
             
-            # Also get POIs within this area
-            pois = self.osm_service.get_pois_around_point(
-                route_request.start_location.latitude,
-                route_request.start_location.longitude,
-                radius=max_distance * 1000
-            )
-            
             # Add POIs to the route
             route["features"].extend(pois["features"])
         
@@ -125,22 +220,30 @@ class WalkingAssistant:
     
     def record_completed_walk(self, walk_record: WalkRecord) -> int:
         """Record a completed walk"""
-        now = datetime.datetime.now()
-        # Estimate start time based on duration
-        started_at = now - datetime.timedelta(minutes=walk_record.duration_minutes)
-        
-        return self.db_service.record_walk(
-            walk_record.user_id,
-            walk_record.start_location.latitude,
-            walk_record.start_location.longitude,
-            walk_record.end_location.latitude,
-            walk_record.end_location.longitude,
-            walk_record.distance_km,
-            walk_record.duration_minutes,
-            started_at,
-            now,
-            None  # No notes for now
-        )
+        return self.record_completed_walks([walk_record])[0]
+    
+    def record_completed_walks(self, walk_records: List[WalkRecord]) -> List[int]:
+        """Record several completed walks in one database transaction"""
+        # Timestamps are stored as epoch milliseconds
+        completed_at_ms = time.time_ns() // 1_000_000
+        rows = []
+        for walk_record in walk_records:
+            # Estimate start time based on duration
+            started_at_ms = completed_at_ms - walk_record.duration_minutes * 60_000
+            rows.append((
+                walk_record.user_id,
+                walk_record.start_location.latitude,
+                walk_record.start_location.longitude,
+                walk_record.end_location.latitude,
+                walk_record.end_location.longitude,
+                walk_record.distance_km,
+                walk_record.duration_minutes,
+                started_at_ms,
+                completed_at_ms,
+                None  # No notes for now
+            ))
+        
+        return self.db_service.record_walks_bulk(rows)
     
     def get_walking_history(self, user_id: str, limit: int = 10) -> List[Dict[str, Any]]:
         """Get walking history for a user"""
@@ -150,57 +253,87 @@ class WalkingAssistant:
         """Get aggregate walking statistics for a user"""
         return self.db_service.get_walking_stats(user_id)
     
-    def analyze_walking_behavior(self, user_id: str) -> str:
-        """Analyze user's walking behavior using LLM"""
+    def _load_analysis_data(self, user_id: str) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]],
+                                                         Optional[Dict[str, Any]]]:
+        """Load the user, recent walks and stats needed for an analysis"""
         # Get user data
         user_data = self.db_service.get_user(user_id)
         if not user_data:
-            return "No user data available."
+            return None, [], None
         
         # Get walking history
-        history = self.db_service.get_walking_history(user_id, limit=20)
+        # The prompt only lists the five most recent walks
+        history = self.db_service.get_walking_history(user_id, limit=5)
         if not history:
-            return "Not enough walking data to analyze behavior."
+            return user_data, [], None
         
         # Get stats
-        stats = self.db_service.get_walking_stats(user_id)
-        
+        return user_data, history, self.db_service.get_walking_stats(user_id)
+    
+    def _analysis_prompt(self, user_data: Dict[str, Any], history: List[Dict[str, Any]],
+                         stats: Dict[str, Any]) -> str:
+        """Build the LLM prompt for a walking behavior analysis"""
         # Prepare recent walks data
         recent_walks_text = ""
-        for i, walk in enumerate(history[:5]):
-            recent_walks_text += f"- {i+1}. Date: {walk['completed_at']}, Distance: {walk['distance_km']:.2f} km, Duration: {walk['duration_minutes']} min\n"
+        for i, walk in enumerate(history):
+            recent_walks_text += f"- {i+1}. Date: {walk['completed_at']}, Distance: {walk['distance_km']:.1f} km, Duration: {walk['duration_minutes']} min\n"
         
-        # Prepare prompt for LLM - using single quotes and proper formatting
-        prompt = f'''Analyze the following walking data for a user:
-
-User preferences:
-- Preferred walking speed: {user_data['preferred_walking_speed']} km/h
+        # Prepare prompt for LLM - using single quotes and proper formatting.
+        # Figures are rounded to one decimal so near-identical stats produce
+        # the same prompt and hit the generation cache.
+        prompt = ANALYSIS_PROMPT_PREFIX + f'''- Preferred walking speed: {user_data['preferred_walking_speed']} km/h
 - Preferred maximum distance: {user_data['preferred_max_distance']} km
 
 Walking statistics:
 - Total walks: {stats['total_walks']}
-- Total distance: {stats['total_distance_km']:.2f} km
+- Total distance: {stats['total_distance_km']:.1f} km
 - Total duration: {stats['total_duration_minutes']} minutes
-- Average walk distance: {stats['avg_distance_km']:.2f} km
-- Average walk duration: {stats['avg_duration_minutes']:.2f} minutes
-- Longest walk: {stats['max_distance_km']:.2f} km
+- Average walk distance: {stats['avg_distance_km']:.1f} km
+- Average walk duration: {stats['avg_duration_minutes']:.1f} minutes
+- Longest walk: {stats['max_distance_km']:.1f} km
 - Longest walk duration: {stats['max_duration_minutes']} minutes
 
 Recent walks:
-{recent_walks_text}
-
-Please provide a brief analysis of this user's walking behavior and habits.
-Include personalized suggestions for improvements and motivation.
-Keep your response concise and friendly.'''
+{recent_walks_text}''' + ANALYSIS_PROMPT_SUFFIX
+        
+        return prompt
+    
+    async def analyze_walking_behavior(self, user_id: str) -> str:
+        """Analyze user's walking behavior using LLM"""
+        user_data, history, stats = await asyncio.to_thread(self._load_analysis_data, user_id)
+        if not user_data:
+            return "No user data available."
+        if not history:
+            return "Not enough walking data to analyze behavior."
+        
+        prompt = self._analysis_prompt(user_data, history, stats)
         
         try:
             # Generate analysis with LLM
-            analysis = generate_text(self.model, self.tokenizer, prompt, max_length=1024)
+            analysis = await self.cached_generate(prompt, max_new_tokens=256, prefix=self.analysis_prefix_cache)
             return analysis
         except Exception as e:
             return f"Error generating analysis: {str(e)}"
     
-    def generate_route_description(self, route: Dict[str, Any]) -> str:
+    async def stream_walking_analysis(self, user_id: str) -> AsyncIterator[str]:
+        """Analyze user's walking behavior, streaming the LLM output as it is generated"""
+        user_data, history, stats = await asyncio.to_thread(self._load_analysis_data, user_id)
+        if not user_data:
+            yield "No user data available."
+            return
+        if not history:
+            yield "Not enough walking data to analyze behavior."
+            return
+        
+        prompt = self._analysis_prompt(user_data, history, stats)
+        
+        try:
+            async for chunk in self.cached_generate_stream(prompt, max_new_tokens=256, prefix=self.analysis_prefix_cache):
+                yield chunk
+        except Exception as e:
+            yield f"Error generating analysis: {str(e)}"
+    
+    async def generate_route_description(self, route: Dict[str, Any]) -> str:
         """Generate a natural language description of a route using LLM"""
         # Extract key information from the route
         distance = route["properties"].get("total_distance_km", 0)
@@ -217,26 +350,35 @@ Keep your response concise and friendly.'''
         poi_text = '\n'.join(poi_descriptions) if poi_descriptions else "No specific points of interest."
         
         # Prepare prompt for LLM
-        prompt = f"""Describe the following walking route in a friendly, conversational way:
-        
-Route details:
-- Total distance: {distance:.2f} km
+        prompt = ROUTE_PROMPT_PREFIX + f"""- Total distance: {distance:.2f} km
 - Estimated duration: {duration} minutes
 
 Points of interest along the route:
-{poi_text}
-
-Provide a brief, engaging description of this route that would encourage someone to try it.
-Include practical information like distance and time, as well as highlighting any interesting features.
-Keep your response concise and conversational."""
+{poi_text}""" + ROUTE_PROMPT_SUFFIX
         
         try:
             # Generate description with LLM
-            description = generate_text(self.model, self.tokenizer, prompt, max_length=768)
+            description = await self.cached_generate(prompt, max_new_tokens=180, prefix=self.route_prefix_cache)
             return description
         except Exception as e:
             return f"Error generating route description: {str(e)}"
     
+    async def aclose(self):
+        """Stop background tasks, then clean up resources"""
+        await self.llm_batcher.aclose()
+        await self.http.aclose()
+        self.close()
+    
     def close(self):
         """Clean up resources"""
         self.db_service.close()
+        self.llm_cache.close()
+        self.osm_service.close()
+        self.routing_service.close()
+        
+        # Drop every reference to the model so its memory can be reclaimed
+        self.llm_batcher = None
+        self.analysis_prefix_cache = None
+        self.route_prefix_cache = None
+        del self.model
+        unload_llm(self.model_name)
@@ -0,0 +1,84 @@
+"""
+Persistent and in-memory caches shared by the services
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import orjson
+
+class CacheStore:
+    """Persistent cache of JSON-serializable values in a single SQLite file, keyed by string"""
+    
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        # WAL lets several uvicorn workers share the file safely
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''')
+    
+    def get(self, key, max_age=None):
+        """Look up a cached value, or None on a miss or when older than max_age seconds"""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT value, created_at FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None or (max_age is not None and time.time() - row[1] >= max_age):
+            return None
+        return orjson.loads(row[0])
+    
+    def scan(self, prefix, max_age=None):
+        """All cached values whose key starts with prefix and that are younger than max_age seconds"""
+        # A key range, so the primary key index serves the prefix match
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        oldest = time.time() - max_age if max_age is not None else 0
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT value FROM cache WHERE key >= ? AND key < ? AND created_at > ?',
+                (prefix, upper, oldest)
+            ).fetchall()
+        return [orjson.loads(row[0]) for row in rows]
+    
+    def put(self, key, value):
+        """Store a value"""
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, created_at) VALUES (?, ?, ?)',
+                (key, orjson.dumps(value), time.time())
+            )
+    
+    def close(self):
+        """Close the cache database"""
+        self.conn.close()
+
+class MemoryLRU:
+    """A bounded in-memory LRU, kept in front of a CacheStore"""
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Look up an entry and mark it recently used, or None on a miss"""
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+    
+    def put(self, key, value):
+        """Add an entry, evicting the least recently used one when full"""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
@@ -1,22 +1,203 @@
 """
 Database service for user data
 """
+import os
+import queue
 import sqlite3
 import datetime
+import threading
+from contextlib import contextmanager
 from typing import List, Dict, Any, Optional
+from urllib.request import pathname2url
+
+# Connection tuning applied right after connect: WAL lets readers run alongside
+# the writer, and synchronous=NORMAL is durable enough under WAL while avoiding
+# a full fsync on every commit.
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Per-connection prepared statement cache size; the hot queries below are
+# static strings, so each is compiled once per connection and then reused.
+_CACHED_STATEMENTS = 256
+
+_SQL_GET_USER = '''
+SELECT user_id, name, preferred_walking_speed, preferred_max_distance
+FROM users WHERE user_id = ?
+'''
+
+_SQL_INSERT_USER = '''
+INSERT INTO users (user_id, name)
+VALUES (?, ?)
+ON CONFLICT(user_id) DO UPDATE SET name = COALESCE(users.name, excluded.name)
+'''
+
+_SQL_ENSURE_USER = 'INSERT OR IGNORE INTO users (user_id) VALUES (?)'
+
+_SQL_INSERT_FAVORITE = '''
+INSERT INTO favorite_locations (user_id, name, latitude, longitude, notes)
+VALUES (?, ?, ?, ?, ?)
+'''
+
+_SQL_GET_FAVORITES = '''
+SELECT id, name, latitude, longitude, notes
+FROM favorite_locations
+WHERE user_id = ?
+'''
+
+_SQL_INSERT_WALK = '''
+INSERT INTO walking_history 
+(user_id, start_latitude, start_longitude, end_latitude, end_longitude, 
+ distance_km, duration_minutes, started_at, completed_at, notes)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+_SQL_GET_HISTORY = '''
+SELECT id, start_latitude, start_longitude, end_latitude, end_longitude,
+       distance_km, duration_minutes, started_at, completed_at, notes
+FROM walking_history
+WHERE user_id = ?
+ORDER BY completed_at DESC
+LIMIT ?
+'''
+
+# Per-user aggregates are maintained incrementally as walks are recorded, so
+# reading stats is a primary-key lookup rather than a scan of the history
+_SQL_UPDATE_STATS = '''
+INSERT INTO user_stats
+(user_id, total_walks, total_distance_km, total_duration_minutes,
+ max_distance_km, max_duration_minutes)
+VALUES (?, 1, ?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    total_walks = total_walks + 1,
+    total_distance_km = total_distance_km + excluded.total_distance_km,
+    total_duration_minutes = total_duration_minutes + excluded.total_duration_minutes,
+    max_distance_km = MAX(max_distance_km, excluded.max_distance_km),
+    max_duration_minutes = MAX(max_duration_minutes, excluded.max_duration_minutes)
+'''
+
+_SQL_BACKFILL_STATS = '''
+INSERT OR IGNORE INTO user_stats
+(user_id, total_walks, total_distance_km, total_duration_minutes,
+ max_distance_km, max_duration_minutes)
+SELECT user_id, COUNT(*), SUM(distance_km), SUM(duration_minutes),
+       MAX(distance_km), MAX(duration_minutes)
+FROM walking_history
+GROUP BY user_id
+'''
+
+# Walks used to store local-time TEXT timestamps; convert them to the same
+# epoch milliseconds record_walk now writes
+_SQL_MIGRATE_TIMESTAMPS = '''
+UPDATE walking_history SET
+    started_at = CAST(ROUND((julianday(started_at, 'utc') - 2440587.5) * 86400000) AS INTEGER),
+    completed_at = CAST(ROUND((julianday(completed_at, 'utc') - 2440587.5) * 86400000) AS INTEGER)
+WHERE typeof(completed_at) = 'text'
+'''
+
+# Bumped whenever initialize_db gains a one-off data migration
+_SCHEMA_VERSION = 1
+
+_SQL_GET_STATS = '''
+SELECT total_walks, total_distance_km, total_duration_minutes,
+       max_distance_km, max_duration_minutes
+FROM user_stats
+WHERE user_id = ?
+'''
+
+def _format_timestamp(epoch_ms: Optional[int]) -> Optional[str]:
+    """Render a stored epoch-millisecond timestamp as local ISO 8601"""
+    if epoch_ms is None:
+        return None
+    return datetime.datetime.fromtimestamp(epoch_ms / 1000).isoformat()
 
 class DatabaseService:
     """Database service for user preferences and history"""
     
-    def __init__(self, db_path):
+    def __init__(self, db_path, read_pool_size: int = 4):
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path)
+        # A single write connection in autocommit mode; write transactions are
+        # opened explicitly with BEGIN IMMEDIATE and serialized with a lock.
+        self._write_conn = self._connect()
+        self._write_lock = threading.Lock()
         self.initialize_db()
+        
+        # Read-only connections for concurrent readers. Opened after the
+        # schema exists since mode=ro cannot create the database file.
+        self._read_pool = queue.Queue(maxsize=read_pool_size)
+        for _ in range(read_pool_size):
+            self._read_pool.put(self._connect(read_only=True))
+    
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """Open a connection shareable across threads with the PRAGMAs applied"""
+        if read_only:
+            uri = f"file:{pathname2url(os.path.abspath(self.db_path))}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False,
+                                   cached_statements=_CACHED_STATEMENTS)
+            # Rows can be indexed by position or converted straight to dicts
+            conn.row_factory = sqlite3.Row
+        else:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False,
+                                   cached_statements=_CACHED_STATEMENTS)
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    @contextmanager
+    def _read(self):
+        """Borrow a read-only connection from the pool"""
+        conn = self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put(conn)
+    
+    @contextmanager
+    def _write(self):
+        """Run a write transaction on the writer, taking the write lock up front"""
+        with self._write_lock:
+            cursor = self._write_conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
     
     def initialize_db(self):
-        """Create necessary tables if they don't exist"""
-        cursor = self.conn.cursor()
-        
+        """Create necessary tables and indexes if they don't exist"""
+        with self._write() as cursor:
+            has_user_stats = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'user_stats'"
+            ).fetchone()
+            self._create_tables(cursor)
+            self._create_indexes(cursor)
+            
+            # Databases created before user_stats existed get it filled once
+            # from the recorded history
+            if not has_user_stats:
+                cursor.execute('INSERT OR IGNORE INTO users (user_id) SELECT DISTINCT user_id FROM walking_history')
+                cursor.execute(_SQL_BACKFILL_STATS)
+            
+            if cursor.execute("PRAGMA user_version").fetchone()[0] < 1:
+                cursor.execute(_SQL_MIGRATE_TIMESTAMPS)
+            cursor.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            
+            # Give the query planner statistics so it picks the indexes; a full
+            # ANALYZE only on first run, afterwards let SQLite decide
+            has_stats = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+            ).fetchone()
+            cursor.execute("PRAGMA optimize" if has_stats else "ANALYZE")
+    
+    def _create_tables(self, cursor):
+        """Create the users, favorite locations, walking history and stats tables"""
         # Create users table
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -54,24 +235,49 @@ class DatabaseService:
             end_longitude REAL,
             distance_km REAL,
             duration_minutes INTEGER,
-            started_at TIMESTAMP,
-            completed_at TIMESTAMP,
+            started_at INTEGER,
+            completed_at INTEGER,
             notes TEXT,
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
         ''')
         
-        self.conn.commit()
+        # Create per-user aggregate stats table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id TEXT PRIMARY KEY,
+            total_walks INTEGER,
+            total_distance_km REAL,
+            total_duration_minutes INTEGER,
+            max_distance_km REAL,
+            max_duration_minutes INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''')
+    
+    def _create_indexes(self, cursor):
+        """Create indexes backing the per-user lookups"""
+        # Lets get_walking_history walk the index in order and stop at LIMIT
+        # instead of scanning and sorting the whole table
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_wh_user_completed
+        ON walking_history (user_id, completed_at DESC)
+        ''')
+        
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_fav_user
+        ON favorite_locations (user_id)
+        ''')
+        # users.user_id is already indexed through its UNIQUE constraint
+    
+    def _ensure_user(self, cursor, user_id: str):
+        """Create a bare user row if needed so foreign keys are satisfied"""
+        cursor.execute(_SQL_ENSURE_USER, (user_id,))
     
     def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Get user by ID"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        SELECT user_id, name, preferred_walking_speed, preferred_max_distance
-        FROM users WHERE user_id = ?
-        ''', (user_id,))
-        
-        row = cursor.fetchone()
+        with self._read() as conn:
+            row = conn.execute(_SQL_GET_USER, (user_id,)).fetchone()
         if not row:
             return None
         
@@ -84,23 +290,15 @@ class DatabaseService:
     
     def create_user(self, user_id: str, name: Optional[str] = None) -> Dict[str, Any]:
         """Create a new user"""
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('''
-            INSERT INTO users (user_id, name)
-            VALUES (?, ?)
-            ''', (user_id, name))
-            self.conn.commit()
-            return self.get_user(user_id)
-        except sqlite3.IntegrityError:
-            # User already exists
-            return self.get_user(user_id)
+        # The user row may already exist, e.g. without a name when a walk was
+        # recorded first; fill in the name then but never overwrite one
+        with self._write() as cursor:
+            cursor.execute(_SQL_INSERT_USER, (user_id, name))
+        return self.get_user(user_id)
     
     def update_user_preferences(self, user_id: str, walking_speed: Optional[float] = None, 
                                 max_distance: Optional[float] = None) -> Dict[str, Any]:
         """Update user preferences"""
-        cursor = self.conn.cursor()
-        
         # Build the update query based on provided parameters
         updates = []
         params = []
@@ -119,106 +317,81 @@ class DatabaseService:
         query = f"UPDATE users SET {', '.join(updates)} WHERE user_id = ?"
         params.append(user_id)
         
-        cursor.execute(query, params)
-        self.conn.commit()
+        with self._write() as cursor:
+            cursor.execute(query, params)
         
         return self.get_user(user_id)
     
     def add_favorite_location(self, user_id: str, name: str, latitude: float, 
                               longitude: float, notes: Optional[str] = None) -> int:
         """Add a favorite location for a user"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        INSERT INTO favorite_locations (user_id, name, latitude, longitude, notes)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, name, latitude, longitude, notes))
+        with self._write() as cursor:
+            self._ensure_user(cursor, user_id)
+            cursor.execute(_SQL_INSERT_FAVORITE, (user_id, name, latitude, longitude, notes))
         
-        self.conn.commit()
         return cursor.lastrowid
     
     def get_favorite_locations(self, user_id: str) -> List[Dict[str, Any]]:
         """Get all favorite locations for a user"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        SELECT id, name, latitude, longitude, notes
-        FROM favorite_locations
-        WHERE user_id = ?
-        ''', (user_id,))
-        
-        locations = []
-        for row in cursor.fetchall():
-            locations.append({
-                'id': row[0],
-                'name': row[1],
-                'latitude': row[2],
-                'longitude': row[3],
-                'notes': row[4]
-            })
-        
-        return locations
+        with self._read() as conn:
+            return [dict(row) for row in conn.execute(_SQL_GET_FAVORITES, (user_id,))]
     
     def record_walk(self, user_id: str, start_lat: float, start_lon: float,
                    end_lat: float, end_lon: float, distance_km: float, 
-                   duration_minutes: int, started_at: datetime.datetime,
-                   completed_at: datetime.datetime, notes: Optional[str] = None) -> int:
-        """Record a completed walk"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        INSERT INTO walking_history 
-        (user_id, start_latitude, start_longitude, end_latitude, end_longitude, 
-         distance_km, duration_minutes, started_at, completed_at, notes)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, start_lat, start_lon, end_lat, end_lon, 
-              distance_km, duration_minutes, started_at, completed_at, notes))
-        
-        self.conn.commit()
-        return cursor.lastrowid
+                   duration_minutes: int, started_at: int,
+                   completed_at: int, notes: Optional[str] = None) -> int:
+        """Record a completed walk; timestamps are epoch milliseconds"""
+        return self.record_walks_bulk([
+            (user_id, start_lat, start_lon, end_lat, end_lon,
+             distance_km, duration_minutes, started_at, completed_at, notes)
+        ])[0]
+    
+    def record_walks_bulk(self, rows: List[tuple]) -> List[int]:
+        """
+        Record several completed walks in a single transaction
+        
+        Each row holds the record_walk arguments in order. All rows share one
+        commit, so a batch costs one WAL sync instead of one per walk.
+        """
+        if not rows:
+            return []
+        
+        with self._write() as cursor:
+            cursor.executemany(_SQL_ENSURE_USER, {(row[0],) for row in rows})
+            cursor.executemany(_SQL_INSERT_WALK, rows)
+            last_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+            cursor.executemany(_SQL_UPDATE_STATS, [
+                (row[0], row[5], row[6], row[5], row[6]) for row in rows
+            ])
+        
+        # The writer holds the lock for the whole transaction, so the new rows
+        # received consecutive ids
+        return list(range(last_id - len(rows) + 1, last_id + 1))
     
     def get_walking_history(self, user_id: str, limit: int = 10) -> List[Dict[str, Any]]:
         """Get walking history for a user"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        SELECT id, start_latitude, start_longitude, end_latitude, end_longitude,
-               distance_km, duration_minutes, started_at, completed_at, notes
-        FROM walking_history
-        WHERE user_id = ?
-        ORDER BY completed_at DESC
-        LIMIT ?
-        ''', (user_id, limit))
-        
-        history = []
-        for row in cursor.fetchall():
-            history.append({
-                'id': row[0],
-                'start_location': {'latitude': row[1], 'longitude': row[2]},
-                'end_location': {'latitude': row[3], 'longitude': row[4]},
-                'distance_km': row[5],
-                'duration_minutes': row[6],
-                'started_at': row[7],
-                'completed_at': row[8],
-                'notes': row[9]
-            })
-        
-        return history
+        # Build each entry straight from the cursor instead of materializing
+        # the rows first
+        with self._read() as conn:
+            return [
+                {
+                    'id': row['id'],
+                    'start_location': {'latitude': row['start_latitude'], 'longitude': row['start_longitude']},
+                    'end_location': {'latitude': row['end_latitude'], 'longitude': row['end_longitude']},
+                    'distance_km': row['distance_km'],
+                    'duration_minutes': row['duration_minutes'],
+                    'started_at': _format_timestamp(row['started_at']),
+                    'completed_at': _format_timestamp(row['completed_at']),
+                    'notes': row['notes']
+                }
+                for row in conn.execute(_SQL_GET_HISTORY, (user_id, limit))
+            ]
     
     def get_walking_stats(self, user_id: str) -> Dict[str, Any]:
         """Get aggregate walking statistics for a user"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        SELECT 
-            COUNT(*) as total_walks,
-            SUM(distance_km) as total_distance,
-            SUM(duration_minutes) as total_duration,
-            AVG(distance_km) as avg_distance,
-            AVG(duration_minutes) as avg_duration,
-            MAX(distance_km) as max_distance,
-            MAX(duration_minutes) as max_duration
-        FROM walking_history
-        WHERE user_id = ?
-        ''', (user_id,))
-        
-        row = cursor.fetchone()
-        if not row or row[0] == 0:
+        with self._read() as conn:
+            row = conn.execute(_SQL_GET_STATS, (user_id,)).fetchone()
+        if not row or not row[0]:
             return {
                 'total_walks': 0,
                 'total_distance_km': 0,
@@ -229,17 +402,20 @@ class DatabaseService:
                 'max_duration_minutes': 0
             }
         
+        total_walks, total_distance, total_duration, max_distance, max_duration = row
         return {
-            'total_walks': row[0],
-            'total_distance_km': row[1],
-            'total_duration_minutes': row[2],
-            'avg_distance_km': row[3],
-            'avg_duration_minutes': row[4],
-            'max_distance_km': row[5],
-            'max_duration_minutes': row[6]
+            'total_walks': total_walks,
+            'total_distance_km': total_distance,
+            'total_duration_minutes': total_duration,
+            'avg_distance_km': total_distance / total_walks,
+            'avg_duration_minutes': total_duration / total_walks,
+            'max_distance_km': max_distance,
+            'max_duration_minutes': max_duration
         }
     
     def close(self):
-        """Close the database connection"""
-        if self.conn:
-            self.conn.close()
+        """Close the writer and every pooled read connection"""
+        while not self._read_pool.empty():
+            self._read_pool.get_nowait().close()
+        if self._write_conn:
+            self._write_conn.close()
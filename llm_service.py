@@ -1,13 +1,58 @@
 """
 Language Model service for text generation
 """
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from typing import Tuple
+import asyncio
+import copy
+import gc
+import importlib.util
+import threading
+from collections import deque
+from contextlib import nullcontext
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from transformers.utils import is_torch_sdpa_available
+from typing import Iterator, List, Optional, Tuple
 import torch
+from cache_store import CacheStore, MemoryLRU
+
+def _attention_implementation() -> Optional[str]:
+    """
+    Pick the fastest fused attention kernel available on this machine, or
+    None to leave the choice to transformers
+    """
+    # FlashAttention-2 needs an Ampere or newer GPU and the flash_attn package;
+    # otherwise PyTorch's scaled_dot_product_attention is the next best thing.
+    # transformers rejects an explicit "sdpa" on torch older than 2.1.1 (the
+    # pinned 2.1.2 has it), so below that the default (eager) attention is used
+    if (torch.cuda.is_available()
+            and torch.cuda.get_device_capability()[0] >= 8
+            and importlib.util.find_spec("flash_attn") is not None):
+        return "flash_attention_2"
+    if is_torch_sdpa_available():
+        return "sdpa"
+    return None
+
+# Default checkpoints: int4 AWQ kernels on GPU, full precision on CPU
+GPU_MODEL_NAME = "TheBloke/Llama-2-7B-Chat-AWQ"
+CPU_MODEL_NAME = "meta-llama/Llama-2-7b-chat-hf"
+
+def default_model_name() -> str:
+    """Pick the default checkpoint for the device this process runs on"""
+    return GPU_MODEL_NAME if torch.cuda.is_available() else CPU_MODEL_NAME
+
+# Models already loaded in this worker process, by name
+_loaded_models = {}
+_load_lock = threading.Lock()
 
 def setup_llm(model_name: str) -> Tuple[AutoModelForCausalLM, AutoTokenizer]:
     """
-    Initialize the language model and tokenizer
+    Initialize the language model and tokenizer, once per worker process
+    
+    Use a pre-quantized AWQ or GPTQ checkpoint (e.g.
+    TheBloke/Llama-2-7B-Chat-AWQ): transformers reads the quantization
+    config from the checkpoint and runs its fused int4 kernels, with no
+    quantization pass at load time. Those kernels need a GPU; on CPU, load
+    a full-precision checkpoint.
     
     Args:
         model_name (str): Name of the Hugging Face model to load
@@ -15,14 +60,26 @@ def setup_llm(model_name: str) -> Tuple[AutoModelForCausalLM, AutoTokenizer]:
     Returns:
         Tuple containing the model and tokenizer
     """
+    with _load_lock:
+        if model_name not in _loaded_models:
+            _loaded_models[model_name] = _load_llm(model_name)
+        return _loaded_models[model_name]
+
+def _load_llm(model_name: str) -> Tuple[AutoModelForCausalLM, AutoTokenizer]:
+    """Load a model and tokenizer from the Hugging Face hub"""
     try:
-        # Load tokenizer
+        # Load tokenizer. Batched generation pads on the left so every prompt
+        # ends right where decoding starts
         tokenizer = AutoTokenizer.from_pretrained(model_name)
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
         
         # Load model
         model = AutoModelForCausalLM.from_pretrained(
             model_name,
             device_map="auto",  # Automatically map to available devices
+            attn_implementation=_attention_implementation(),
             torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32
         )
         
@@ -33,8 +90,102 @@ def setup_llm(model_name: str) -> Tuple[AutoModelForCausalLM, AutoTokenizer]:
     except Exception as e:
         raise Exception(f"Failed to load model {model_name}: {str(e)}")
 
+def unload_llm(model_name: str):
+    """Forget a loaded model and free the memory it held"""
+    with _load_lock:
+        _loaded_models.pop(model_name, None)
+    release_device_memory()
+
+# Text after the prefix is tokenized behind this anchor, whose ids are then
+# dropped: tokenized on its own, SentencePiece would mark it as a word start
+_FRAGMENT_ANCHOR = "\n"
+
+# Shaped like the user-specific lines of the prompts; used at startup to check
+# that the stitched ids match a tokenization of the whole prompt
+_PROBE_MIDDLES = ("- Total walks: 3\n", "- Total distance: 1.50 km")
+
+class PromptPrefix:
+    """
+    A fixed prompt prefix whose key/value cache is computed once at startup
+    
+    An optional fixed suffix (the closing instructions) is tokenized once as
+    well, so prompts of the form prefix + middle + suffix only tokenize the
+    middle. This is used only when a startup check shows that the stitched
+    ids equal those of the whole prompt.
+    """
+    
+    def __init__(self, model: AutoModelForCausalLM, tokenizer: AutoTokenizer, text: str,
+                 suffix: str = ""):
+        self.text = text
+        self.input_ids = tokenizer(text, return_tensors="pt").input_ids.to(model.device)
+        self._anchor_length = len(tokenizer(_FRAGMENT_ANCHOR, add_special_tokens=False).input_ids)
+        self.suffix = suffix
+        self.suffix_ids = self._fragment_ids(tokenizer, suffix)
+        self.splits_cleanly = all(
+            torch.equal(
+                self._stitch(tokenizer, middle),
+                tokenizer(text + middle + suffix, return_tensors="pt").input_ids.to(model.device)
+            )
+            for middle in _PROBE_MIDDLES
+        )
+        
+        # Run the prefill for the prefix once; generate_text hands each call
+        # its own copy so the prefix never has to be recomputed
+        self.past_key_values = DynamicCache()
+        with torch.no_grad():
+            model(self.input_ids, past_key_values=self.past_key_values, use_cache=True)
+    
+    def _fragment_ids(self, tokenizer: AutoTokenizer, text: str) -> torch.Tensor:
+        """Token ids of text as it tokenizes inside a longer prompt"""
+        ids = tokenizer(_FRAGMENT_ANCHOR + text, return_tensors="pt", add_special_tokens=False).input_ids
+        return ids[:, self._anchor_length:].to(self.input_ids.device)
+    
+    def _stitch(self, tokenizer: AutoTokenizer, middle: str) -> torch.Tensor:
+        """Prefix ids, then the ids of the middle, then the suffix ids"""
+        return torch.cat([self.input_ids, self._fragment_ids(tokenizer, middle), self.suffix_ids], dim=1)
+    
+    def encode(self, tokenizer: AutoTokenizer, prompt: str) -> Optional[torch.Tensor]:
+        """Token ids of a prompt made of prefix, middle and suffix, or None if it can't be split"""
+        if (not self.splits_cleanly or not prompt.startswith(self.text)
+                or not prompt.endswith(self.suffix)
+                or len(prompt) < len(self.text) + len(self.suffix)):
+            return None
+        return self._stitch(tokenizer, prompt[len(self.text):len(prompt) - len(self.suffix)])
+
+# Sampling settings shared by every generation path, so a prompt is treated
+# the same whether it runs alone, streamed or in a batch
+GENERATION_KWARGS = {
+    "use_cache": True,
+    "temperature": 0.7,  # Moderate creativity
+    "top_p": 0.9,        # Nucleus sampling
+    "do_sample": True,
+}
+
+def _encode_prompt(model: AutoModelForCausalLM, tokenizer: AutoTokenizer, prompt: str,
+                   prefix: Optional[PromptPrefix] = None) -> Tuple[torch.Tensor, Optional[DynamicCache]]:
+    """Encode a prompt, reusing the prefix KV cache when it starts with the prefix tokens"""
+    # Long prompts are cut to the model's context like generate_texts does
+    # with truncation=True
+    if prefix is not None:
+        input_ids = prefix.encode(tokenizer, prompt)
+        if input_ids is not None:
+            # generate() extends the cache in place, so each call needs a copy
+            return input_ids[:, :tokenizer.model_max_length], copy.deepcopy(prefix.past_key_values)
+    
+    input_ids = tokenizer(prompt, return_tensors="pt", truncation=True).input_ids.to(model.device)
+    if prefix is not None and prompt.startswith(prefix.text):
+        # The prefix's last token can merge with the text that follows it, so
+        # the cache is only valid when the token ids line up
+        n = prefix.input_ids.shape[1]
+        if input_ids.shape[1] > n and torch.equal(input_ids[:, :n], prefix.input_ids):
+            return input_ids, copy.deepcopy(prefix.past_key_values)
+    
+    return input_ids, None
+
+@torch.inference_mode()
 def generate_text(model: AutoModelForCausalLM, tokenizer: AutoTokenizer, 
-                 prompt: str, max_length: int = 1024) -> str:
+                 prompt: str, max_new_tokens: int = 200,
+                 prefix: Optional[PromptPrefix] = None) -> str:
     """
     Generate text using the language model
     
@@ -42,33 +193,267 @@ def generate_text(model: AutoModelForCausalLM, tokenizer: AutoTokenizer,
         model: Loaded language model
         tokenizer: Corresponding tokenizer
         prompt (str): Input prompt for text generation
-        max_length (int): Maximum length of generated text
+        max_new_tokens (int): Maximum number of tokens to generate
+        prefix (PromptPrefix): Precomputed prefix the prompt starts with, if any
         
     Returns:
         str: Generated text
+        
+    Errors are left to the caller, so a failed generation is never mistaken
+    for (and cached as) a real response.
     """
-    try:
-        # Encode the prompt
-        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    input_ids, past_key_values = _encode_prompt(model, tokenizer, prompt, prefix)
+    
+    # Generate text
+    outputs = model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        past_key_values=past_key_values,
+        max_new_tokens=max_new_tokens,
+        pad_token_id=tokenizer.pad_token_id,
+        **GENERATION_KWARGS
+    )
+    
+    # Decode only the newly generated tokens, dropping the prompt
+    generated_text = tokenizer.decode(outputs[0][input_ids.shape[1]:], skip_special_tokens=True)
+    
+    return generated_text.strip()
+
+class _StopOnEvent(StoppingCriteria):
+    """Stops generation once an event is set, e.g. when the reader went away"""
+    
+    def __init__(self, event: threading.Event):
+        self.event = event
+    
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+def generate_text_stream(model: AutoModelForCausalLM, tokenizer: AutoTokenizer,
+                         prompt: str, max_new_tokens: int = 200,
+                         prefix: Optional[PromptPrefix] = None,
+                         lock: Optional[threading.Lock] = None,
+                         stop: Optional[threading.Event] = None) -> Iterator[str]:
+    """
+    Generate text, yielding decoded chunks as soon as they are produced
+    
+    Generation stops early when the generator is closed or stop is set.
+    
+    Args:
+        model: Loaded language model
+        tokenizer: Corresponding tokenizer
+        prompt (str): Input prompt for text generation
+        max_new_tokens (int): Maximum number of tokens to generate
+        prefix (PromptPrefix): Precomputed prefix the prompt starts with, if any
+        lock (threading.Lock): Held while generating, to share the model with an LLMBatcher
+        stop (threading.Event): Set by the caller to stop generating
         
-        # Generate text
-        outputs = model.generate(
-            **inputs,
-            max_length=max_length,
-            num_return_sequences=1,
-            temperature=0.7,  # Moderate creativity
-            top_p=0.9,       # Nucleus sampling
-            do_sample=True,
-            pad_token_id=tokenizer.eos_token_id
-        )
+    Yields:
+        str: Pieces of generated text, prompt excluded
+    """
+    input_ids, past_key_values = _encode_prompt(model, tokenizer, prompt, prefix)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop = stop or threading.Event()
+    errors = []
+    
+    def run():
+        try:
+            # Inference mode is per thread, so enter it here
+            with lock or nullcontext(), torch.inference_mode():
+                if stop.is_set():
+                    # Cancelled while waiting for the model
+                    streamer.end()
+                    return
+                model.generate(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    past_key_values=past_key_values,
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=tokenizer.pad_token_id,
+                    stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop)]),
+                    streamer=streamer,
+                    **GENERATION_KWARGS
+                )
+        except Exception as e:
+            # Unblock the consumer; the error is re-raised below
+            errors.append(e)
+            streamer.end()
+    
+    # generate() feeds the streamer from a background thread
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        for text in streamer:
+            yield text
+    finally:
+        # Stops generate() when the consumer closes the generator early
+        stop.set()
+    thread.join()
+    
+    if errors:
+        raise errors[0]
+
+@torch.inference_mode()
+def generate_texts(model: AutoModelForCausalLM, tokenizer: AutoTokenizer,
+                   prompts: List[str], max_new_tokens: int = 200) -> List[str]:
+    """
+    Generate text for several prompts with a single padded generate call
+    
+    Args:
+        model: Loaded language model
+        tokenizer: Corresponding tokenizer (left padding)
+        prompts (List[str]): Input prompts
+        max_new_tokens (int): Maximum number of tokens to generate per prompt
         
-        # Decode and clean the output
-        generated_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    Returns:
+        List[str]: Generated text for each prompt, in order
+    """
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True, truncation=True).to(model.device)
+    
+    outputs = model.generate(
+        **inputs,
+        max_new_tokens=max_new_tokens,
+        pad_token_id=tokenizer.pad_token_id,
+        **GENERATION_KWARGS
+    )
+    
+    # With left padding every row's prompt ends at the same column
+    prompt_length = inputs.input_ids.shape[1]
+    return [
+        tokenizer.decode(output[prompt_length:], skip_special_tokens=True).strip()
+        for output in outputs
+    ]
+
+
+class LLMBatcher:
+    """
+    Collects concurrent generation requests and runs them as one batch
+    
+    Only requests with the same max_new_tokens share a batch, so no request
+    decodes past its own budget.
+    """
+    
+    def __init__(self, model: AutoModelForCausalLM, tokenizer: AutoTokenizer,
+                 max_batch: int = 8, max_wait: float = 0.02):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # Created on first use so they bind to the server's event loop
+        self._queue = None
+        self._worker = None
+        # Held while the model generates; streamed generations share it so
+        # only one generate call runs at a time
+        self.lock = threading.Lock()
+    
+    async def submit(self, prompt: str, max_new_tokens: int = 200,
+                     prefix: Optional[PromptPrefix] = None) -> str:
+        """Queue a prompt and wait for its generated text"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
         
-        # Remove the prompt from the output if present
-        if generated_text.startswith(prompt):
-            generated_text = generated_text[len(prompt):].strip()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, max_new_tokens, prefix, future))
+        return await future
+    
+    async def _run(self):
+        """Drain the queue into batches of up to max_batch, waiting at most max_wait"""
+        loop = asyncio.get_running_loop()
+        # Requests with another budget than the batch being collected; they
+        # start the following batches, oldest first
+        held = deque()
+        while True:
+            batch = [held.popleft() if held else await self._queue.get()]
+            budget = batch[0][1]
+            for request in list(held):
+                if len(batch) < self.max_batch and request[1] == budget:
+                    held.remove(request)
+                    batch.append(request)
             
-        return generated_text
-    except Exception as e:
-        return f"Error generating text: {str(e)}"
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request[1] == budget:
+                    batch.append(request)
+                else:
+                    held.append(request)
+            
+            try:
+                results = await asyncio.to_thread(self._generate_batch, batch)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (*_, future), text in zip(batch, results):
+                    if not future.done():
+                        future.set_result(text)
+    
+    async def aclose(self):
+        """Stop the background batching task"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+    
+    def _generate_batch(self, batch) -> List[str]:
+        """Run one generate call for a batch of queued requests"""
+        with self.lock:
+            # A lone request keeps the single-prompt path and its prefix KV cache
+            if len(batch) == 1:
+                prompt, max_new_tokens, prefix, _ = batch[0]
+                return [generate_text(self.model, self.tokenizer, prompt, max_new_tokens=max_new_tokens, prefix=prefix)]
+            
+            # Every request in a batch has the same budget
+            prompts = [prompt for prompt, *_ in batch]
+            max_new_tokens = batch[0][1]
+            return generate_texts(self.model, self.tokenizer, prompts, max_new_tokens=max_new_tokens)
+
+
+def release_device_memory():
+    """Hand cached GPU memory back to the driver after a model is dropped"""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class GenerationCache:
+    """Persistent cache of generated text, keyed by prompt hash, token budget and model"""
+    
+    def __init__(self, db_path: str, model_name: str, maxsize: int = 1024):
+        self.model_name = model_name
+        self.store = CacheStore(db_path)
+        # Recently used responses are also kept in memory
+        self._memory = MemoryLRU(maxsize)
+    
+    def _key(self, prompt_hash: str, max_new_tokens: int) -> str:
+        return f"{prompt_hash}:{max_new_tokens}:{self.model_name}"
+    
+    def get(self, prompt_hash: str, max_new_tokens: int) -> Optional[str]:
+        """Look up a cached response, or None on a miss"""
+        key = self._key(prompt_hash, max_new_tokens)
+        response = self._memory.get(key)
+        if response is None:
+            response = self.store.get(key)
+            if response is not None:
+                self._memory.put(key, response)
+        return response
+    
+    def put(self, prompt_hash: str, max_new_tokens: int, response: str):
+        """Store a generated response"""
+        key = self._key(prompt_hash, max_new_tokens)
+        self._memory.put(key, response)
+        self.store.put(key, response)
+    
+    def close(self):
+        """Close the cache database"""
+        self.store.close()
@@ -2,25 +2,258 @@
 Location services for OpenStreetMap and routing
 """
 import os
-import json
+import math
+import time
+import asyncio
+import functools
+import threading
+import httpx
+import orjson
 import requests
-import geopy
-import geopy.distance
-from shapely.geometry import Point, Polygon, LineString, shape
-import geopandas as gpd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+from pyproj import Geod
+from shapely import STRtree, points
+from shapely.geometry import box
+from cache_store import CacheStore, MemoryLRU
+
+# Bump to invalidate cached responses written by older releases
+CACHE_VERSION = 3
+
+# Cached Overpass responses older than this are fetched again
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Requests are snapped to a 0.001 degree (~110 m) grid so nearby requests share
+# cached answers; the search radius grows by the worst-case snapping offset so
+# everything around the requested point is still covered
+GRID_DECIMALS = 3
+GRID_SNAP_ERROR_M = 80
+
+# POI tiles are fetched with this margin on top of the requested radius, so
+# later requests nearby fall inside an already cached tile. Kept small: the
+# tile area grows with the square of its radius, and so does the Overpass
+# query time against its 25 s timeout
+TILE_RADIUS_MARGIN = 0.2
+
+# Mean Earth radius, for haversine distances
+EARTH_RADIUS_M = 6371008.8
+
+# Length of one degree of latitude in meters
+METERS_PER_DEGREE = 111320
+
+# Number of boundary points of an isochrone circle
+ISOCHRONE_POINTS = 64
+
+# Built once: the WGS84 geodesic solver, and the boundary azimuths, which run
+# anticlockwise as GeoJSON expects of an exterior ring
+_GEOD = Geod(ellps="WGS84")
+_ISOCHRONE_AZIMUTHS = np.linspace(360, 0, ISOCHRONE_POINTS + 1)[:-1]
+
+# Scenic-route legs shorter than this are not worth routing
+MIN_SEGMENT_M = 20
+
+# Tag keys that describe what a scenic-route POI is
+SCENIC_TAG_KEYS = frozenset(("leisure", "natural", "tourism", "historic"))
+
+# POI tiles kept in memory in front of the persistent cache
+POI_MEMORY_SIZE = 256
+
+# Overpass and OSRM compress their (often multi-MB) JSON responses when asked.
+# Request bodies stay uncompressed: Overpass does not accept gzip uploads,
+# and the compact queries are only a few hundred bytes anyway
+HTTP_HEADERS = {"Accept-Encoding": "gzip, deflate"}
+
+def make_async_client():
+    """A pooled HTTP/2 client for the async code paths"""
+    return httpx.AsyncClient(
+        http2=True,
+        headers=HTTP_HEADERS,
+        limits=httpx.Limits(max_keepalive_connections=32),
+        timeout=30.0
+    )
+
+def _make_session():
+    """A pooled keep-alive session that retries transient upstream failures"""
+    session = requests.Session()
+    session.headers.update(HTTP_HEADERS)
+    # Overpass queries are read-only, so retrying their POSTs is safe
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset(("GET", "POST"))
+    )
+    session.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=retry))
+    return session
+
+@functools.lru_cache(maxsize=32)
+def _query_template(poi_types):
+    """
+    Overpass query for a tuple of POI types, with {radius}, {lat} and {lon}
+    left as placeholders
+    """
+    # One regex-union statement per tag key; relations are skipped by the
+    # parser, so only nodes and ways are requested
+    values_by_key = {}
+    for poi_type in poi_types:
+        key, value = poi_type.split('=', 1)
+        values_by_key.setdefault(key, []).append(value)
+    
+    # Built in one join with no whitespace, since the body counts toward
+    # Overpass' quota. Tags and geometry only: no way node ids or metadata
+    statements = "".join(
+        f'nw["{key}"~"^({"|".join(values)})$"](around:{{radius}},{{lat}},{{lon}});'
+        for key, values in values_by_key.items()
+    )
+    return f"[out:json][timeout:25];({statements});out tags geom;"
+
+def _snap_to_grid(lat, lon):
+    """Snap coordinates to the cache grid"""
+    return round(lat, GRID_DECIMALS), round(lon, GRID_DECIMALS)
+
+def _radius_bucket(radius):
+    """Round a search radius up to the next 100 m"""
+    return int(math.ceil(radius / 100.0)) * 100
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def _haversine_vec(lat0, lon0, lats, lons):
+    """Great-circle distances in meters from one point to arrays of points"""
+    phi0 = np.radians(lat0)
+    phis = np.radians(lats)
+    dphi = phis - phi0
+    dlambda = np.radians(lons - lon0)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi0) * np.cos(phis) * np.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+class PoiTile:
+    """
+    A cached POI tile, with its features flattened into NumPy arrays: every
+    vertex's coordinates and owning feature, and each feature's POI types as
+    a bitmask. An R-tree over the vertices answers proximity queries.
+    """
+    
+    def __init__(self, geojson, poi_types):
+        self.geojson = geojson
+        self.features = geojson['features']
+        # One bit per POI type the tile was fetched for (at most 63)
+        self.type_bits = {poi_type: 1 << i for i, poi_type in enumerate(poi_types)}
+        type_tags = [(*poi_type.split('=', 1), bit) for poi_type, bit in self.type_bits.items()]
+        
+        coords = []
+        owners = []
+        categories = []
+        for i, feature in enumerate(self.features):
+            geometry = feature['geometry']
+            vertices = [geometry['coordinates']] if geometry['type'] == 'Point' else geometry['coordinates']
+            coords.extend(vertices)
+            owners.extend([i] * len(vertices))
+            
+            properties = feature['properties']
+            categories.append(sum(bit for key, value, bit in type_tags if properties.get(key) == value))
+        
+        coords = np.array(coords, dtype=np.float64).reshape(-1, 2)
+        self.lons = coords[:, 0]
+        self.lats = coords[:, 1]
+        self.owners = np.array(owners, dtype=np.intp)
+        self.categories = np.array(categories, dtype=np.int64)
+        self.tree = STRtree(points(coords))
+    
+    def within(self, lat, lon, radius, poi_types):
+        """
+        Features of the given POI types within radius meters of the point, in
+        their original order
+        
+        Like Overpass' around filter, a way counts when any vertex is in range.
+        """
+        # The R-tree narrows the search to vertices in the disc's bounding box
+        dlat = radius / METERS_PER_DEGREE
+        dlon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        candidates = self.tree.query(box(lon - dlon, lat - dlat, lon + dlon, lat + dlat))
+        if len(candidates) == 0:
+            return []
+        
+        distances = _haversine_vec(lat, lon, self.lats[candidates], self.lons[candidates])
+        hits = np.unique(self.owners[candidates[distances <= radius]])
+        
+        wanted_bits = sum(self.type_bits.get(poi_type, 0) for poi_type in poi_types)
+        hits = hits[(self.categories[hits] & wanted_bits) != 0]
+        return [self.features[i] for i in hits]
 
 class OpenStreetMapService:
     """Service to interact with OpenStreetMap via Overpass API"""
     
-    def __init__(self, cache_dir):
+    def __init__(self, cache_dir, http=None):
         self.overpass_url = "https://overpass-api.de/api/interpreter"
         self.cache_dir = cache_dir
         os.makedirs(self.cache_dir, exist_ok=True)
+        
+        # Shared pooled client for the async code paths, and a pooled session
+        # for the sync ones
+        self.http = http
+        self.session = _make_session()
+        
+        # Cached POI tiles: an index of what each tile covers, with the tiles
+        # themselves in an in-memory LRU in front of the persistent cache
+        self.store = CacheStore(os.path.join(self.cache_dir, "cache.sqlite"))
+        self._index = self.store.scan(f"v{CACHE_VERSION}:index:", max_age=CACHE_TTL_SECONDS)
+        self._memory = MemoryLRU(POI_MEMORY_SIZE)
+        self._lock = threading.Lock()
+        self._cached_isochrone = functools.lru_cache(maxsize=4096)(self._build_isochrone)
     
     def get_pois_around_point(self, lat, lon, radius=500, poi_types=None):
         """
         Get points of interest around a specific location
         """
+        poi_types = self._poi_types(poi_types)
+        geojson = self.query_pois_within(lat, lon, radius, poi_types)
+        if geojson is None:
+            # Send request to Overpass API for a tile around the point
+            tile = self._tile_for(lat, lon, radius, poi_types)
+            response = self.session.post(self.overpass_url, data={"data": self._overpass_query(*tile)})
+            response.raise_for_status()
+            geojson = self._answer_from_response(tile, response.content, lat, lon, radius, poi_types)
+        
+        return geojson
+    
+    async def aget_pois_around_point(self, lat, lon, radius=500, poi_types=None, http=None):
+        """
+        Get points of interest around a specific location without blocking the event loop
+        
+        http overrides the shared client, for callers running their own event loop.
+        Only the HTTP request runs on the loop; the cache lookups, parsing and
+        spatial filtering run on a worker thread.
+        """
+        poi_types = self._poi_types(poi_types)
+        geojson = await asyncio.to_thread(self.query_pois_within, lat, lon, radius, poi_types)
+        if geojson is None:
+            tile = self._tile_for(lat, lon, radius, poi_types)
+            response = await (http or self.http).post(self.overpass_url, data={"data": self._overpass_query(*tile)})
+            response.raise_for_status()
+            geojson = await asyncio.to_thread(
+                self._answer_from_response, tile, response.content, lat, lon, radius, poi_types
+            )
+        
+        return geojson
+    
+    def _answer_from_response(self, tile, content, lat, lon, radius, poi_types):
+        """
+        Store a freshly fetched Overpass tile and answer the request from it
+        """
+        poi_tile = self._store_tile(tile, orjson.loads(content))
+        return self._filter_tile(poi_tile, lat, lon, radius, set(poi_types))
+    
+    def _poi_types(self, poi_types):
+        """
+        Default the POI types to the ones interesting for walking
+        """
         if poi_types is None:
             # Default POI types that are interesting for walking
             poi_types = [
@@ -34,38 +267,90 @@ class OpenStreetMapService:
                 'amenity=bench'
             ]
         
-        # Create cache key from parameters
-        cache_key = f"{lat}_{lon}_{radius}_{'_'.join(poi_types)}"
-        cache_file = f"{self.cache_dir}/{cache_key}.json"
+        return tuple(poi_types)
+    
+    def _tile_for(self, lat, lon, radius, poi_types):
+        """
+        Tile to fetch for a POI request: a grid-snapped disc larger than the request
+        """
+        lat, lon = _snap_to_grid(lat, lon)
+        tile_radius = _radius_bucket(radius * (1 + TILE_RADIUS_MARGIN) + GRID_SNAP_ERROR_M)
+        return lat, lon, tile_radius, poi_types
+    
+    def _tile_key(self, tile):
+        """
+        Cache key of a tile
+        """
+        lat, lon, radius, poi_types = tile
+        return f"{lat}_{lon}_{radius}_{'_'.join(poi_types)}"
+    
+    def _load_tile(self, tile_key, poi_types):
+        """
+        Get a tile from memory or the persistent cache, or None if it is gone
+        """
+        poi_tile = self._memory.get(tile_key)
+        if poi_tile is not None:
+            return poi_tile
         
-        # Check if we have cached results
-        if os.path.exists(cache_file):
-            with open(cache_file, 'r') as f:
-                return json.load(f)
+        geojson = self.store.get(f"v{CACHE_VERSION}:tile:{tile_key}")
+        if geojson is None:
+            return None
         
-        # Build the Overpass query
-        overpass_query = """
-        [out:json];
-        (
+        # The R-tree is rebuilt on load; an unpickled STRtree is rebuilt anyway
+        poi_tile = PoiTile(geojson, poi_types)
+        self._memory.put(tile_key, poi_tile)
+        return poi_tile
+    
+    def query_pois_within(self, lat, lon, radius, poi_types=None):
         """
+        Get points of interest around a location from the cached tiles only
         
-        for poi_type in poi_types:
-            key, value = poi_type.split('=')
-            overpass_query += f"""
-            node["{key}"="{value}"](around:{radius},{lat},{lon});
-            way["{key}"="{value}"](around:{radius},{lat},{lon});
-            relation["{key}"="{value}"](around:{radius},{lat},{lon});
-            """
-        
-        overpass_query += """
-        );
-        out body geom;
+        A tile can serve the request when it was fetched for every requested
+        POI type and its disc contains the requested one. Returns None when
+        no cached tile covers the request.
         """
+        wanted = set(self._poi_types(poi_types))
+        now = time.time()
+        with self._lock:
+            index = list(self._index)
         
-        # Send request to Overpass API
-        response = requests.post(self.overpass_url, data={"data": overpass_query})
-        data = response.json()
+        for entry in index:
+            if now - entry['fetched_at'] >= CACHE_TTL_SECONDS:
+                continue
+            if not wanted.issubset(entry['poi_types']):
+                continue
+            if _haversine_m(lat, lon, entry['lat'], entry['lon']) + radius > entry['radius']:
+                continue
+            
+            poi_tile = self._load_tile(entry['key'], entry['poi_types'])
+            if poi_tile is not None:
+                return self._filter_tile(poi_tile, lat, lon, radius, wanted)
         
+        return None
+    
+    def _filter_tile(self, poi_tile, lat, lon, radius, wanted):
+        """
+        Select the features of a tile that match the request
+        """
+        return {
+            'type': 'FeatureCollection',
+            'features': poi_tile.within(lat, lon, radius, wanted)
+        }
+    
+    def _overpass_query(self, lat, lon, radius, poi_types):
+        """
+        Build the Overpass query for a POI tile
+        """
+        return _query_template(poi_types).format(radius=radius, lat=lat, lon=lon)
+    
+    def _store_tile(self, tile, data):
+        """
+        Convert an Overpass response to a GeoJSON tile, index it and cache it
+        
+        A response carrying a remark (a timeout or memory error on the Overpass
+        side) may be truncated: it still answers the current request but is
+        neither cached nor indexed.
+        """
         # Convert to GeoJSON format
         features = []
         
@@ -102,114 +387,268 @@ class OpenStreetMapService:
             'features': features
         }
         
-        # Cache the results
-        with open(cache_file, 'w') as f:
-            json.dump(geojson, f)
+        lat, lon, radius, poi_types = tile
+        poi_tile = PoiTile(geojson, poi_types)
+        if data.get('remark'):
+            print(f"Incomplete Overpass response, not caching the tile: {data['remark']}")
+            return poi_tile
+        
+        # Cache the results and record what the tile covers
+        tile_key = self._tile_key(tile)
+        self.store.put(f"v{CACHE_VERSION}:tile:{tile_key}", geojson)
+        
+        self._memory.put(tile_key, poi_tile)
+        with self._lock:
+            now = time.time()
+            self._index = [
+                entry for entry in self._index
+                if entry['key'] != tile_key and now - entry['fetched_at'] < CACHE_TTL_SECONDS
+            ]
+            entry = {
+                'key': tile_key,
+                'lat': lat,
+                'lon': lon,
+                'radius': radius,
+                'poi_types': list(poi_types),
+                'fetched_at': now
+            }
+            self._index.append(entry)
+        self.store.put(f"v{CACHE_VERSION}:index:{tile_key}", entry)
         
-        return geojson
+        return poi_tile
+    
+    def close(self):
+        """
+        Close the pooled HTTP session and the cache
+        """
+        self.session.close()
+        self.store.close()
     
     def generate_walkable_isochrone(self, lat, lon, walking_time_minutes=15):
         """
         Generate a polygon representing the area reachable within a given walking time
         """
+        lat, lon = _snap_to_grid(lat, lon)
+        return self._cached_isochrone(lat, lon, walking_time_minutes)
+    
+    def _build_isochrone(self, lat, lon, walking_time_minutes):
+        """
+        Build the isochrone polygon for a grid-snapped location
+        """
         # Very rough approximation: average walking speed is about 5km/h or ~83m/min
         walking_distance_meters = walking_time_minutes * 83
         
-        # Create a point
-        center = Point(lon, lat)
-        
-        # Create a GeoSeries with the point
-        gs = gpd.GeoSeries([center], crs="EPSG:4326")
-        
-        # Convert to a projected CRS for accurate distance calculation
-        gs_proj = gs.to_crs(epsg=3857)
-        
-        # Create a buffer around the point in meters
-        buffer = gs_proj.buffer(walking_distance_meters)
-        
-        # Convert back to WGS84
-        buffer_wgs84 = buffer.to_crs(epsg=4326)
+        # Walk the geodesic circle of that radius around the point on the
+        # WGS84 ellipsoid; no projection or buffering needed
+        lons, lats, _ = _GEOD.fwd(
+            np.full_like(_ISOCHRONE_AZIMUTHS, lon),
+            np.full_like(_ISOCHRONE_AZIMUTHS, lat),
+            _ISOCHRONE_AZIMUTHS,
+            np.full_like(_ISOCHRONE_AZIMUTHS, walking_distance_meters)
+        )
         
-        # Convert to GeoJSON
-        geojson_polygon = json.loads(buffer_wgs84.to_json())
+        ring = np.column_stack([lons, lats]).tolist()
+        ring.append(ring[0])
         
-        return geojson_polygon
+        return {
+            'type': 'FeatureCollection',
+            'features': [{
+                'id': '0',
+                'type': 'Feature',
+                'properties': {},
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [ring]
+                }
+            }]
+        }
 
 
 class RoutingService:
     """Service to get walking routes using OSRM public endpoints"""
     
-    def __init__(self, cache_dir, osm_service):
+    # Query parameters for every OSRM route request
+    ROUTE_PARAMS = {
+        "steps": "true",
+        "geometries": "geojson",
+        "overview": "full"
+    }
+    
+    def __init__(self, cache_dir, osm_service, http=None):
         # Using the public OSRM demo server - In production, you'd want to self-host this
         self.osrm_url = "https://router.project-osrm.org/route/v1/foot"
+        self.osrm_table_url = "https://router.project-osrm.org/table/v1/foot"
         self.cache_dir = cache_dir
         self.osm_service = osm_service
         os.makedirs(self.cache_dir, exist_ok=True)
+        self.store = CacheStore(os.path.join(self.cache_dir, "cache.sqlite"))
+        
+        # Shared pooled client for the async code paths, and a pooled session
+        # for the sync ones
+        self.http = http
+        self.session = _make_session()
+    
+    def close(self):
+        """
+        Close the pooled HTTP session and the cache
+        """
+        self.session.close()
+        self.store.close()
+    
+    def _route_cache_key(self, start_lat, start_lon, end_lat, end_lon):
+        """
+        Cache key of a route
+        """
+        return f"route:{start_lat}_{start_lon}_{end_lat}_{end_lon}"
+    
+    def _route_url(self, start_lat, start_lon, end_lat, end_lon):
+        """
+        OSRM route URL for two points
+        """
+        return f"{self.osrm_url}/{start_lon},{start_lat};{end_lon},{end_lat}"
     
     def get_walking_route(self, start_lat, start_lon, end_lat, end_lon):
         """
         Get a walking route between two points
         """
         # Check cache first
-        cache_key = f"{start_lat}_{start_lon}_{end_lat}_{end_lon}"
-        cache_file = f"{self.cache_dir}/{cache_key}.json"
+        cache_key = self._route_cache_key(start_lat, start_lon, end_lat, end_lon)
+        cached = self.store.get(cache_key)
+        if cached is not None:
+            return cached
         
-        if os.path.exists(cache_file):
-            with open(cache_file, 'r') as f:
-                return json.load(f)
+        try:
+            url = self._route_url(start_lat, start_lon, end_lat, end_lon)
+            response = self.session.get(url, params=self.ROUTE_PARAMS)
+            return self._store_route(cache_key, response.content)
+        
+        except Exception as e:
+            print(f"Error getting walking route: {str(e)}")
+            return None
+    
+    async def aget_walking_route(self, start_lat, start_lon, end_lat, end_lon, http=None):
+        """
+        Get a walking route between two points without blocking the event loop
         
-        # Construct the API URL
-        url = f"{self.osrm_url}/{start_lon},{start_lat};{end_lon},{end_lat}"
+        http overrides the shared client, for callers running their own event loop.
+        Cache reads and writes run on a worker thread.
+        """
+        cache_key = self._route_cache_key(start_lat, start_lon, end_lat, end_lon)
+        cached = await asyncio.to_thread(self.store.get, cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            url = self._route_url(start_lat, start_lon, end_lat, end_lon)
+            response = await (http or self.http).get(url, params=self.ROUTE_PARAMS)
+            return await asyncio.to_thread(self._store_route, cache_key, response.content)
+        
+        except Exception as e:
+            print(f"Error getting walking route: {str(e)}")
+            return None
+    
+    def _store_route(self, cache_key, content):
+        """
+        Convert an OSRM response body to a GeoJSON feature and cache it
+        """
+        data = orjson.loads(content)
+        if data["code"] != "Ok":
+            print(f"Error getting route: {data.get('message', 'Unknown error')}")
+            return None
+        
+        # Extract the route geometry
+        route = data["routes"][0]
+        geometry = route["geometry"]
+        distance = route["distance"]  # in meters
+        duration = route["duration"]  # in seconds
+        
+        result = {
+            "type": "Feature",
+            "geometry": geometry,
+            "properties": {
+                "distance": distance,
+                "duration": duration,
+                "duration_minutes": int(duration / 60)
+            }
+        }
+        
+        # Cache the results
+        self.store.put(cache_key, result)
+        
+        return result
+    
+    async def aget_leg_table(self, points, http=None):
+        """
+        Get the distance and duration of each leg of a multi-point walk
+        
+        A single OSRM table request replaces one route request per leg. Each
+        point i is a source and point i+1 the matching destination, so leg i
+        is entry [i][i] of the returned matrices. Unroutable legs are None.
+        """
+        coords = ";".join(f"{lon},{lat}" for lat, lon in points)
+        cache_key = f"table:{coords}"
+        cached = await asyncio.to_thread(self.store.get, cache_key)
+        if cached is not None:
+            return cached
+        
+        legs = range(len(points) - 1)
         params = {
-            "steps": "true",
-            "geometries": "geojson",
-            "overview": "full"
+            "sources": ";".join(str(i) for i in legs),
+            "destinations": ";".join(str(i + 1) for i in legs),
+            "annotations": "distance,duration"
         }
         
         try:
-            response = requests.get(url, params=params)
-            data = response.json()
+            response = await (http or self.http).get(f"{self.osrm_table_url}/{coords}", params=params)
+            data = orjson.loads(response.content)
             
             if data["code"] != "Ok":
-                print(f"Error getting route: {data.get('message', 'Unknown error')}")
+                print(f"Error getting route table: {data.get('message', 'Unknown error')}")
                 return None
             
-            # Extract the route geometry
-            route = data["routes"][0]
-            geometry = route["geometry"]
-            distance = route["distance"]  # in meters
-            duration = route["duration"]  # in seconds
-            
             result = {
-                "type": "Feature",
-                "geometry": geometry,
-                "properties": {
-                    "distance": distance,
-                    "duration": duration,
-                    "duration_minutes": int(duration / 60)
-                }
+                "distances": [data["distances"][i][i] for i in legs],
+                "durations": [data["durations"][i][i] for i in legs]
             }
             
             # Cache the results
-            with open(cache_file, 'w') as f:
-                json.dump(result, f)
+            await asyncio.to_thread(self.store.put, cache_key, result)
             
             return result
         
         except Exception as e:
-            print(f"Error getting walking route: {str(e)}")
+            print(f"Error getting route table: {str(e)}")
             return None
     
-    def generate_scenic_route(self, start_lat, start_lon, max_distance_km=3):
+    def generate_scenic_route(self, start_lat, start_lon, max_distance_km=3, include_geometry=False):
+        """
+        Generate a scenic circular walking route from outside an event loop
+        """
+        async def run():
+            # The shared client belongs to the server's event loop, so this
+            # loop gets a client of its own
+            async with make_async_client() as http:
+                return await self.agenerate_scenic_route(
+                    start_lat, start_lon, max_distance_km, include_geometry=include_geometry, http=http
+                )
+        
+        return asyncio.run(run())
+    
+    async def agenerate_scenic_route(self, start_lat, start_lon, max_distance_km=3,
+                                     include_geometry=False, http=None):
         """
         Generate a scenic circular walking route starting and ending at the same point
+        
+        Totals come from one OSRM table request. With include_geometry the
+        route of every leg is fetched instead and added as a feature.
         """
         # First, get POIs around the starting point
-        pois = self.osm_service.get_pois_around_point(
+        pois = await self.osm_service.aget_pois_around_point(
             start_lat, 
             start_lon, 
             radius=max_distance_km * 1000,
-            poi_types=['leisure=park', 'natural=wood', 'tourism=attraction', 'historic=monument']
+            poi_types=['leisure=park', 'natural=wood', 'tourism=attraction', 'historic=monument'],
+            http=http
         )
         
         # If we don't have enough POIs, return None
@@ -217,36 +656,54 @@ class RoutingService:
             print("Not enough POIs found for a scenic route")
             return None
         
-        # Pick some interesting POIs to visit (at most 3-4 points to keep the route manageable)
-        selected_pois = []
-        parks = [p for p in pois['features'] if 'leisure' in p['properties'] and p['properties']['leisure'] == 'park']
-        attractions = [p for p in pois['features'] if 'tourism' in p['properties'] or 'historic' in p['properties']]
+        # Pick some interesting POIs to visit (at most 3-4 points to keep the route manageable).
+        # One pass finds the first park and the first attraction and records
+        # each POI's type
+        park = attraction = None
+        poi_kinds = {}
+        for poi in pois['features']:
+            properties = poi['properties']
+            poi_kinds[id(poi)] = next((k for k in properties if k in SCENIC_TAG_KEYS), "point of interest")
+            if park is None and properties.get('leisure') == 'park':
+                park = poi
+            if attraction is None and ('tourism' in properties or 'historic' in properties):
+                attraction = poi
         
         # Prioritize parks and attractions
-        if parks:
-            selected_pois.append(parks[0])
-        if attractions:
-            selected_pois.append(attractions[0])
-        
-        # Add more POIs if needed
-        while len(selected_pois) < 3 and len(pois['features']) > len(selected_pois):
-            # Add a point that's not already selected
-            for poi in pois['features']:
-                if poi not in selected_pois:
-                    selected_pois.append(poi)
-                    break
+        selected_pois = []
+        selected_ids = set()
+        for poi in (park, attraction):
+            if poi is not None and id(poi) not in selected_ids:
+                selected_pois.append(poi)
+                selected_ids.add(id(poi))
+        
+        # Add more POIs if needed, in their original order
+        for poi in pois['features']:
+            if len(selected_pois) >= 3:
+                break
+            if id(poi) not in selected_ids:
+                selected_pois.append(poi)
+                selected_ids.add(id(poi))
         
         # Create a circular route starting and ending at the provided point
         route_points = [(start_lat, start_lon)]
         
-        # Add the POIs
+        # Add the POIs; ways are visited at their first vertex
         for poi in selected_pois:
-            coords = poi['geometry']['coordinates']
+            geometry = poi['geometry']
+            coords = geometry['coordinates'] if geometry['type'] == 'Point' else geometry['coordinates'][0]
             route_points.append((coords[1], coords[0]))  # Convert from [lon, lat] to (lat, lon)
         
         # Close the loop by returning to start
         route_points.append((start_lat, start_lon))
         
+        # Drop points that (nearly) repeat the previous one, so no zero-length
+        # leg is sent to OSRM
+        points = [route_points[0]]
+        for point in route_points[1:]:
+            if _haversine_m(points[-1][0], points[-1][1], point[0], point[1]) > MIN_SEGMENT_M:
+                points.append(point)
+        
         # Now get the walking directions for each segment
         combined_route = {
             "type": "FeatureCollection",
@@ -258,22 +715,29 @@ class RoutingService:
             }
         }
         
-        for i in range(len(route_points) - 1):
-            start = route_points[i]
-            end = route_points[i + 1]
-            
-            route_segment = self.get_walking_route(start[0], start[1], end[0], end[1])
+        if len(points) > 1 and include_geometry:
+            # The segments are independent, so request them all at once
+            segments = await asyncio.gather(*(
+                self.aget_walking_route(start[0], start[1], end[0], end[1], http=http)
+                for start, end in zip(points, points[1:])
+            ))
             
-            if route_segment:
-                combined_route["features"].append(route_segment)
-                combined_route["properties"]["total_distance"] += route_segment["properties"]["distance"]
-                combined_route["properties"]["total_duration"] += route_segment["properties"]["duration"]
+            for route_segment in segments:
+                if route_segment:
+                    combined_route["features"].append(route_segment)
+                    combined_route["properties"]["total_distance"] += route_segment["properties"]["distance"]
+                    combined_route["properties"]["total_duration"] += route_segment["properties"]["duration"]
+        elif len(points) > 1:
+            table = await self.aget_leg_table(points, http=http)
+            if table:
+                combined_route["properties"]["total_distance"] = sum(d for d in table["distances"] if d is not None)
+                combined_route["properties"]["total_duration"] = sum(d for d in table["durations"] if d is not None)
         
         # Add POI information
         for poi in selected_pois:
             combined_route["properties"]["pois"].append({
                 "name": poi["properties"].get("name", "Unnamed location"),
-                "type": next((k for k, v in poi["properties"].items() if k in ["leisure", "natural", "tourism", "historic"]), "point of interest"),
+                "type": poi_kinds[id(poi)],
                 "location": poi["geometry"]["coordinates"]
             })
         
@@ -4,7 +4,6 @@ Main entry point for the Walking AI Assistant application
 import uvicorn
 import os
 import argparse
-from api import app
 
 def main():
     """Run the Walking AI Assistant application"""
@@ -13,17 +12,32 @@ def main():
     parser.add_argument("--port", type=int, default=8000, help="Port to bind the server")
     parser.add_argument("--db-path", type=str, default="walking_assistant.db", help="Path to the SQLite database")
     parser.add_argument("--cache-dir", type=str, default="cache", help="Directory for caching data")
-    parser.add_argument("--model-name", type=str, default="meta-llama/Llama-2-7b-chat-hf", help="LLM model name")
+    parser.add_argument("--model-name", type=str, default=None,
+                        help="LLM model name (default: an AWQ checkpoint on GPU, "
+                             "the full-precision chat model on CPU)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes (each loads its own copy of the LLM)")
     
     args = parser.parse_args()
     
     # Set environment variables
     os.environ["DB_PATH"] = args.db_path
     os.environ["CACHE_DIR"] = args.cache_dir
-    os.environ["MODEL_NAME"] = args.model_name
+    if args.model_name:
+        os.environ["MODEL_NAME"] = args.model_name
     
-    # Run the server
-    uvicorn.run(app, host=args.host, port=args.port)
+    # Run the server. The app is passed as an import string so that the
+    # environment above is in place before api.py builds the assistant, and
+    # so uvicorn can spawn multiple workers. uvloop and httptools (from
+    # uvicorn[standard]) replace the pure-Python event loop and HTTP parser.
+    uvicorn.run(
+        "api:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop="uvloop",
+        http="httptools"
+    )
 
 if __name__ == "__main__":
     main()
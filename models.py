@@ -2,34 +2,54 @@
 Models for the Walking AI Assistant application
 """
 from typing import List, Dict, Any, Optional, Union
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
-class User(BaseModel):
+class FrozenModel(BaseModel):
+    """
+    Base for the API models: immutable, hashable and tolerant of extra fields
+    
+    Pydantic v2 has no slots option; freezing is what it offers instead.
+    Derive changed copies with model_copy(update=...).
+    """
+    model_config = ConfigDict(frozen=True, extra='ignore')
+
+class User(FrozenModel):
     user_id: str
     name: Optional[str] = None
     preferred_walking_speed: Optional[float] = None
     preferred_max_distance: Optional[float] = None
 
-class Location(BaseModel):
+class Location(FrozenModel):
     latitude: float
     longitude: float
     name: Optional[str] = None
     notes: Optional[str] = None
 
-class RouteRequest(BaseModel):
+class RouteRequest(FrozenModel):
     user_id: str
     start_location: Location
     end_location: Optional[Location] = None
     max_distance_km: Optional[float] = None
     scenic: Optional[bool] = False
+    # Scenic routes only: include each leg's geometry, not just the totals
+    include_geometry: Optional[bool] = True
 
-class WalkRecord(BaseModel):
+class BatchGenerateRequest(FrozenModel):
+    prompts: List[str] = Field(..., min_length=1, max_length=32)
+    max_new_tokens: int = Field(256, ge=1, le=1024)
+
+class WalkRecord(FrozenModel):
     user_id: str
     start_location: Location
     end_location: Location
     distance_km: float
     duration_minutes: int
 
+class BulkWalkRequest(FrozenModel):
+    # One write transaction per request; bounded so it can't hold the
+    # database writer for long
+    walks: List[WalkRecord] = Field(..., min_length=1, max_length=500)
+
 
 # File: llm_service.py
 """